@@ -0,0 +1,391 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, Iterator, List, Optional, Type, TypeVar
+
+from main import AddShiftCommand, AddSubstitutionCommand, CharProcessor, \
+    ColumnarRecords, CommandProcessor, ShiftCipher, SubstitutionCipher, \
+    TextStore, VigenereCipher, iter_steps, read_steps, tokenize_command
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+T = TypeVar("T")
+OWNERS = 1000
+ALPHABET = "abcdefghijklmnopqrstuvwxyz"
+REVERSED_ALPHABET = ALPHABET[::-1]
+WORDS = [
+    "lorem", "ipsum", "dolor", "sit", "amet", "Consectetur", "ADIPISCING",
+    "elit", "sed", "do", "eiusmod", "tempor", "123", "!?", "Ünïcode",
+]
+
+
+def generate_text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def generate_add_commands(count: int, seed: int = 0) -> Iterator[str]:
+    rng = random.Random(seed)
+    for i in range(count):
+        text = generate_text(rng, rng.randint(1, 30))
+        owner = f"owner{rng.randrange(OWNERS)}"
+        date = f"2024-{rng.randrange(12) + 1:02d}-{rng.randrange(28) + 1:02d}"
+        if i % 2:
+            yield f'ADD SHIFT "{text}" {owner} {date} {rng.randint(-30, 30)}'
+        else:
+            yield (
+                f'ADD SUBSTITUTION "{text}" {owner} {date} '
+                f'"{ALPHABET}" "{REVERSED_ALPHABET}"'
+            )
+
+
+def generate_command_file(
+    path: str, count: int, seed: int = 0, removes: int = 10
+) -> None:
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as file:
+        for i, line in enumerate(generate_add_commands(count, seed), 1):
+            file.write(line + "\n")
+            if removes and i % max(count // removes, 1) == 0:
+                file.write(f"REM owner == owner{rng.randrange(OWNERS)}\n")
+        file.write("PRINT\n")
+
+
+def build_processor(
+    size: int, seed: int = 0, compaction: Optional[str] = None
+) -> CommandProcessor:
+    processor = CommandProcessor(
+        open(os.devnull, "w", encoding="utf-8"),
+        TextStore(compaction=compaction),
+    )
+    for line in generate_add_commands(size, seed):
+        processor.process_command(line)
+    return processor
+
+
+def measure(
+    run: Callable[[], object],
+    setup: Optional[Callable[[], object]] = None,
+    repeat: int = 3,
+) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_ciphers(size: int, repeat: int) -> Dict[str, float]:
+    rng = random.Random(size)
+    text = generate_text(rng, size)
+    results = {}
+
+    def shift() -> None:
+        cipher = ShiftCipher(text, "owner", "2024-01-01", 13)
+        cipher.encrypted_text
+        cipher.decrypted_text
+
+    def substitution() -> None:
+        cipher = SubstitutionCipher(
+            text, "owner", "2024-01-01", ALPHABET, REVERSED_ALPHABET
+        )
+        cipher.encrypted_text
+        cipher.decrypted_text
+
+    def vigenere() -> None:
+        cipher = VigenereCipher(text, "owner", "2024-01-01", "lemon")
+        cipher.encrypted_text
+        cipher.decrypted_text
+
+    def shift_char() -> None:
+        for char in text:
+            CharProcessor.shift_char(char, 13)
+
+    data = text.encode("ascii", "ignore")
+    cipher = ShiftCipher("", "owner", "2024-01-01", 13)
+
+    def shift_bytes() -> None:
+        cipher.decrypt_bytes(cipher.encrypt_bytes(data))
+
+    results["shift_cipher"] = measure(shift, repeat=repeat)
+    results["bytes_shift_cipher"] = measure(shift_bytes, repeat=repeat)
+    results["substitution_cipher"] = measure(substitution, repeat=repeat)
+    results["vigenere_cipher"] = measure(vigenere, repeat=repeat)
+    results["shift_char"] = measure(shift_char, repeat=repeat)
+    return results
+
+
+def bench_parsing(size: int, repeat: int) -> Dict[str, float]:
+    processor = CommandProcessor()
+    lines = [line.split(" ", 2)[2] for line in generate_add_commands(size)]
+
+    def parse() -> None:
+        for line in lines:
+            processor.parse_quoted_string(line)
+
+    # A command log: every ADD is preceded by two comment lines.
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "commands.txt")
+        with open(path, "w", encoding="utf-8") as file:
+            for i, line in enumerate(generate_add_commands(size)):
+                file.write(f"# command {i}\n#\n{line}\n")
+
+        def read_text() -> None:
+            with open(path, encoding="utf-8") as file:
+                for _ in iter_steps(file):
+                    pass
+
+        def read_mapped() -> None:
+            for _ in read_steps(path):
+                pass
+
+        return {
+            "parse_quoted_string": measure(parse, repeat=repeat),
+            "read_text_file": measure(read_text, repeat=repeat),
+            "read_mapped_file": measure(read_mapped, repeat=repeat),
+        }
+
+
+REM_PREDICATES = {
+    "rem_owner_eq": "REM owner == owner1",
+    "rem_owner_ne": "REM owner != owner1",
+    "rem_date_eq": "REM date == 2024-01-01",
+    "rem_date_lt": "REM date < 2024-02-01",
+    "rem_date_between": "REM date BETWEEN 2024-03-01 2024-03-31",
+    "rem_length_gt": "REM length > 150",
+    "rem_length_lt": "REM length < 20",
+    "rem_compound": "REM (owner == owner1 OR owner == owner2) AND length > 50",
+}
+
+
+def bench_store(size: int, repeat: int) -> Dict[str, float]:
+    results = {}
+    holder: List[CommandProcessor] = []
+
+    def setup() -> None:
+        holder[:] = [build_processor(size)]
+
+    for name, command in REM_PREDICATES.items():
+        results[name] = measure(
+            lambda: holder[0].process_command(command), setup, repeat
+        )
+
+    def setup_tombstones() -> None:
+        holder[:] = [build_processor(size, compaction="manual")]
+
+    # REM that only flags records; the purge is measured separately.
+    results["rem_owner_ne_tombstone"] = measure(
+        lambda: holder[0].process_command(REM_PREDICATES["rem_owner_ne"]),
+        setup_tombstones, repeat,
+    )
+
+    def setup_removed() -> None:
+        setup_tombstones()
+        holder[0].process_command(REM_PREDICATES["rem_owner_ne"])
+
+    results["compact"] = measure(
+        lambda: holder[0].process_command("COMPACT"), setup_removed, repeat
+    )
+    # A fresh store per run, so PRINT pays for encryption and decryption
+    # instead of rendering cached results.
+    results["print"] = measure(
+        lambda: holder[0].process_command("PRINT"), setup, repeat
+    )
+    return results
+
+
+def traced_bytes(build: Callable[[], object]) -> int:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        kept = build()
+        gc.collect()
+        used: int = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del kept
+    return used
+
+
+def dict_based(cls: Type[T]) -> Type[T]:
+    # The cipher layout before __slots__: class attributes shadow the
+    # inherited slots, so every field lands in an instance __dict__. The
+    # unused slots stay in each object, which overstates it by 8 bytes
+    # apiece.
+    names = {
+        name for klass in cls.__mro__
+        for name in getattr(klass, "__slots__", ())
+    }
+    return type(f"Dict{cls.__name__}", (cls,), dict.fromkeys(names))
+
+
+def bench_memory(size: int, repeat: int) -> Dict[str, float]:
+    # Bytes per record held by a store built from ``size`` ADD lines.
+    # "records" builds the ciphers straight from the parsed commands, so
+    # every owner, date and alphabet is a separate string, and "dict" does
+    # the same with dict-based ciphers as the baseline; "pooled" goes
+    # through CommandProcessor, which shares them through its intern pool.
+    lines = list(generate_add_commands(size))
+
+    def records(
+        substitution: Type[SubstitutionCipher], shift: Type[ShiftCipher]
+    ) -> Callable[[], TextStore]:
+        def build() -> TextStore:
+            store = TextStore()
+            for line in lines:
+                command = tokenize_command(line)
+                if isinstance(command, AddSubstitutionCommand):
+                    store.append(substitution(*command))
+                elif isinstance(command, AddShiftCommand):
+                    store.append(shift(*command))
+            return store
+        return build
+
+    def processor(store: TextStore) -> Callable[[], CommandProcessor]:
+        def build() -> CommandProcessor:
+            processor = CommandProcessor(
+                open(os.devnull, "w", encoding="utf-8"), store
+            )
+            for line in lines:
+                processor.process_command(line)
+            return processor
+        return build
+
+    return {
+        "memory_dict_bytes": traced_bytes(records(
+            dict_based(SubstitutionCipher), dict_based(ShiftCipher)
+        )) / size,
+        "memory_records_bytes":
+            traced_bytes(records(SubstitutionCipher, ShiftCipher)) / size,
+        "memory_pooled_bytes":
+            traced_bytes(processor(TextStore())) / size,
+        "memory_columnar_bytes":
+            traced_bytes(processor(TextStore(ColumnarRecords()))) / size,
+    }
+
+
+SUITES = {
+    "ciphers": bench_ciphers,
+    "memory": bench_memory,
+    "parsing": bench_parsing,
+    "store": bench_store,
+}
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def unit(name: str) -> str:
+    return "B" if name.endswith("_bytes") else "s"
+
+
+def run_benchmarks(
+    sizes: List[int], suites: List[str], repeat: int
+) -> Dict[str, Dict[str, float]]:
+    results: Dict[str, Dict[str, float]] = {}
+    for size in sizes:
+        for suite in suites:
+            for name, seconds in SUITES[suite](size, repeat).items():
+                results.setdefault(name, {})[str(size)] = seconds
+                print(
+                    f"{name:<22} {size:>10} {seconds:.6f}{unit(name)}",
+                    file=sys.stderr,
+                )
+    return results
+
+
+def compare(
+    baseline: Dict[str, Dict[str, float]],
+    current: Dict[str, Dict[str, float]],
+    threshold: float,
+) -> List[str]:
+    regressions = []
+    for name, by_size in current.items():
+        for size, value in by_size.items():
+            before = baseline.get(name, {}).get(size)
+            if before and value > before * (1 + threshold):
+                regressions.append(
+                    f"{name} @ {size}: {before:.6f}{unit(name)} -> "
+                    f"{value:.6f}{unit(name)} "
+                    f"(+{(value / before - 1) * 100:.1f}%)"
+                )
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark main.py.")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+        help="store/payload sizes, e.g. 100 1000 10000000",
+    )
+    parser.add_argument(
+        "--suite", choices=sorted(SUITES), action="append",
+        help="run only these suites (default: all)",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--compare", help="baseline JSON results to check")
+    parser.add_argument(
+        "--threshold", type=float, default=0.10,
+        help="allowed slowdown against the baseline (0.10 = 10%%)",
+    )
+    parser.add_argument(
+        "--generate", metavar="PATH",
+        help="only write a synthetic command file with the first size",
+    )
+    args = parser.parse_args(argv)
+
+    if args.generate:
+        generate_command_file(args.generate, args.sizes[0])
+        return 0
+
+    results = run_benchmarks(
+        args.sizes, args.suite or sorted(SUITES), args.repeat
+    )
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(baseline, results, args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
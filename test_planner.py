@@ -0,0 +1,130 @@
+import io
+import random
+import unittest
+
+from main import CommandProcessor, ExpressionParser, QueryPlanner, \
+    ShiftCipher, TextStore, matches
+
+OWNERS = ["alice", "bob", "carol", "dave"]
+DATES = ["2024-01-01", "2024-01-15", "2024-02-29", "2024-03-10", "not-a-date"]
+OPERATORS = ["==", "!=", "<", ">", "<=", ">=", "BETWEEN"]
+
+
+def random_condition(rng: random.Random) -> str:
+    field = rng.choice(["owner", "date", "length"])
+    if field == "owner":
+        return f"owner {rng.choice(['==', '!='])} {rng.choice(OWNERS)}"
+    operator = rng.choice(OPERATORS)
+    if field == "date":
+        values = sorted(rng.sample(DATES[:-1], 2))
+    else:
+        values = sorted(str(rng.randrange(12)) for _ in range(2))
+    count = 2 if operator == "BETWEEN" else 1
+    return f"{field} {operator} {' '.join(values[:count])}"
+
+
+def random_expression(rng: random.Random, depth: int = 0) -> str:
+    choice = rng.randrange(5) if depth < 3 else 0
+    if choice == 0:
+        return random_condition(rng)
+    if choice == 1:
+        return f"NOT {random_expression(rng, depth + 1)}"
+    if choice == 2:
+        return f"({random_expression(rng, depth + 1)})"
+    keyword = "AND" if choice == 3 else "OR"
+    return (
+        f"{random_expression(rng, depth + 1)} {keyword} "
+        f"{random_expression(rng, depth + 1)}"
+    )
+
+
+def random_store(rng: random.Random, size: int) -> TextStore:
+    store = TextStore()
+    for _ in range(size):
+        store.append(ShiftCipher(
+            "x" * rng.randrange(12), rng.choice(OWNERS), rng.choice(DATES),
+            rng.randint(-5, 5),
+        ))
+    return store
+
+
+class PlannerTest(unittest.TestCase):
+    def test_plans_match_record_filter(self) -> None:
+        rng = random.Random(0)
+        for _ in range(300):
+            store = random_store(rng, rng.randrange(60))
+            text = random_expression(rng)
+            expression = ExpressionParser(text).parse()
+            expected = {
+                record_id for record_id, record in store.records.items()
+                if matches(record, expression)
+            }
+            plan = QueryPlanner(store).plan(expression)
+            self.assertEqual(set(plan.run()), expected, text)
+
+    def test_rem_removes_matching_records(self) -> None:
+        rng = random.Random(1)
+        for compaction in (None, "inline", "manual"):
+            for _ in range(100):
+                store = random_store(rng, rng.randrange(60))
+                text = random_expression(rng)
+                expression = ExpressionParser(text).parse()
+                kept = [
+                    record for record in store
+                    if not matches(record, expression)
+                ]
+                store.compaction = compaction
+                processor = CommandProcessor(io.StringIO(), store)
+                processor.process_command(f"REM {text}")
+                self.assertEqual(list(store), kept, text)
+
+    def test_explain_leaves_store_alone(self) -> None:
+        store = random_store(random.Random(2), 50)
+        output = io.StringIO()
+        processor = CommandProcessor(output, store)
+        processor.process_command(
+            "EXPLAIN REM owner == alice AND NOT length < 5"
+        )
+        self.assertEqual(len(store), 50)
+        # Row and cost estimates depend on the store; the shape does not.
+        lines = output.getvalue().splitlines()
+        self.assertEqual(
+            [line.split(" (rows")[0] for line in lines],
+            [
+                "Intersect",
+                "  IndexLookup owner == alice",
+                "  Complement NOT length < 5",
+                "    IndexRange length < 5",
+            ],
+        )
+
+    def test_plain_conditions_keep_their_meaning(self) -> None:
+        output = io.StringIO()
+        processor = CommandProcessor(output)
+        for owner in ("Smith(Jr)", "AND", "bob"):
+            processor.process_command(
+                f'ADD SHIFT "hello" {owner} 2024-01-01 1'
+            )
+        processor.process_command("REM owner == Smith(Jr)")
+        processor.process_command("REM owner == AND")
+        self.assertEqual(
+            [record.get_owner() for record in processor.texts], ["bob"]
+        )
+        processor.process_command("REM length >= 5")
+        self.assertEqual(len(processor.texts), 0)
+
+    def test_malformed_conditions_keep_their_message(self) -> None:
+        output = io.StringIO()
+        processor = CommandProcessor(output)
+        processor.process_command("REM name == Smith(Jr)")
+        processor.process_command("REM owner < (x)")
+        processor.process_command("REM NOT (owner == x")
+        self.assertEqual(output.getvalue().splitlines(), [
+            "Unknown REM condition: name == Smith(Jr)",
+            "Unknown REM condition: owner < (x)",
+            "Invalid REM expression: missing ')'",
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import asyncio
+import io
+import os
+import tempfile
+import unittest
+
+from main import CommandProcessor, CommandServer
+
+
+class CommandServerTest(unittest.TestCase):
+    def test_paths_are_relative_to_the_file_root(self) -> None:
+        with tempfile.TemporaryDirectory() as root:
+            os.mkdir(os.path.join(root, "sub"))
+            with open(os.path.join(root, "sub", "payload.txt"), "w") as file:
+                file.write("hello")
+            processor = CommandProcessor(io.StringIO())
+            server = CommandServer(processor, file_root=root)
+            output = io.StringIO()
+
+            async def run() -> None:
+                for line in (
+                    "ADD SHIFT @sub/payload.txt bob 2024-01-01 1",
+                    "ADD SHIFT @missing.txt bob 2024-01-01 1",
+                    "SAVE sub/store.snap",
+                    "LOAD missing.snap",
+                    "SAVE .",
+                ):
+                    await server.run(line, output)
+
+            asyncio.run(run())
+            processor.texts.close()
+        self.assertEqual(output.getvalue().split("\n\n"), [
+            "Added SHIFT cipher for owner 'bob'",
+            "Cannot add payload file 'missing.txt': [Errno 2] No such file "
+            "or directory: 'missing.txt'",
+            "Saved 1 items to 'sub/store.snap'",
+            "Cannot load snapshot: [Errno 2] No such file or directory: "
+            "'missing.snap'",
+            "Path '.' is outside the file root",
+            "",
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()
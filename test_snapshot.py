@@ -0,0 +1,100 @@
+import io
+import os
+import tempfile
+import unittest
+
+from main import CommandProcessor, ShiftCipher, Snapshot, SnapshotRecords, \
+    SubstitutionCipher, VigenereCipher, write_snapshot
+
+
+class SnapshotTest(unittest.TestCase):
+    def test_round_trip(self) -> None:
+        records = [
+            SubstitutionCipher(
+                "Hello, Wörld", "alice", "2024-01-01", "abc", "xyz"
+            ),
+            ShiftCipher("shift \ud800 me", "bob", "2024-02-02", -3),
+            VigenereCipher("Attack at dawn", "carol", "bad-date", "lemon"),
+            # Encrypting fails; it must fail again after loading.
+            SubstitutionCipher("abc", "dave", "2024-03-03", "abc", "x"),
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "store.snap")
+            self.assertEqual(write_snapshot(records, path), len(records))
+            snapshot = Snapshot(path)
+            self.assertEqual(len(snapshot), len(records))
+            for index, original in enumerate(records):
+                loaded = snapshot.record(index)
+                self.assertIs(type(loaded), type(original))
+                self.assertEqual(
+                    (loaded.text, loaded.owner_name, loaded.date),
+                    (original.text, original.owner_name, original.date),
+                )
+                if index < 3:
+                    self.assertEqual(loaded.render(), original.render())
+            with self.assertRaises(IndexError):
+                snapshot.record(3).encrypted_text
+            self.assertEqual(
+                list(snapshot.index_entries()),
+                [
+                    (index, record.get_owner(), record.get_date(),
+                     record.get_text_length())
+                    for index, record in enumerate(records)
+                ],
+            )
+
+    def test_save_and_load_commands(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "store.snap")
+            output = io.StringIO()
+            processor = CommandProcessor(output)
+            for i in range(10):
+                processor.process_command(
+                    f'ADD SHIFT "text {i}" owner{i % 3} 2024-01-0{i % 9 + 1}'
+                    f' {i}'
+                )
+            processor.process_command("REM owner == owner1")
+            processor.process_command("PRINT")
+            before = output.getvalue().split("ENCRYPTED TEXTS")[-1]
+
+            processor.process_command(f'SAVE "{path}"')
+            processor.process_command(f'LOAD "{path}"')
+            self.assertIsInstance(processor.texts.records, SnapshotRecords)
+            output.seek(0)
+            output.truncate()
+            processor.process_command("PRINT")
+            self.assertEqual(
+                output.getvalue().split("ENCRYPTED TEXTS")[-1], before
+            )
+            processor.process_command("REM owner == owner2")
+            self.assertEqual(
+                {record.get_owner() for record in processor.texts},
+                {"owner0"},
+            )
+            processor.texts.close()
+
+    def test_streamed_records(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            payload = os.path.join(directory, "payload.txt")
+            with open(payload, "w", encoding="utf-8") as file:
+                file.write("Grüße, " * 1000)
+            path = os.path.join(directory, "store.snap")
+            output = io.StringIO()
+            processor = CommandProcessor(output, payload_chunk_size=7)
+            processor.process_command(
+                f'ADD SHIFT @"{payload}" alice 2024-01-01 3'
+            )
+            processor.process_command(
+                f'ADD SUBSTITUTION @"{payload}" bob 2024-01-01 abc xyz'
+            )
+            expected = [record.render() for record in processor.texts]
+            processor.process_command(f'SAVE "{path}"')
+            processor.process_command(f'LOAD "{path}"')
+            self.assertEqual(
+                [record.render() for record in processor.texts], expected
+            )
+            processor.texts.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+import io
+import os
+import tempfile
+import unittest
+from typing import List
+
+from main import AddShiftCommand, CommandProcessor, RemoveCommand, \
+    WriteAheadLog
+
+
+class WriteAheadLogTest(unittest.TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "store.wal")
+
+    def write(self, count: int) -> List[AddShiftCommand]:
+        commands = [
+            AddShiftCommand(f"text {i}", "owner", "2024-01-01", i)
+            for i in range(count)
+        ]
+        wal = WriteAheadLog(self.path, "never")
+        for command in commands:
+            wal.append(command)
+        wal.append(RemoveCommand("owner", "==", "nobody"))
+        wal.close()
+        return commands
+
+    def replay(self) -> List[object]:
+        wal = WriteAheadLog(self.path, "never")
+        try:
+            return list(wal.replay())
+        finally:
+            wal.close()
+
+    def test_replay_returns_logged_commands(self) -> None:
+        commands = self.write(5)
+        self.assertEqual(
+            self.replay(),
+            [*commands, RemoveCommand("owner", "==", "nobody")],
+        )
+
+    def test_torn_tail_is_cut_off(self) -> None:
+        commands = self.write(5)
+        size = os.path.getsize(self.path)
+        with open(self.path, "r+b") as file:
+            file.truncate(size - 3)
+        self.assertEqual(self.replay(), commands)
+        # The torn frame is gone, so new entries follow the intact ones.
+        cut = os.path.getsize(self.path)
+        self.assertLess(cut, size - 3)
+        wal = WriteAheadLog(self.path, "never")
+        list(wal.replay())
+        wal.append(RemoveCommand("owner", "==", "owner"))
+        wal.close()
+        self.assertEqual(
+            self.replay(),
+            [*commands, RemoveCommand("owner", "==", "owner")],
+        )
+
+    def test_corrupt_frame_ends_the_log(self) -> None:
+        commands = self.write(5)
+        with open(self.path, "r+b") as file:
+            file.seek(-2, os.SEEK_END)
+            file.write(b"\xff\xff")
+        self.assertEqual(self.replay(), commands)
+
+    def test_processor_recovers_store(self) -> None:
+        processor = CommandProcessor(
+            io.StringIO(), wal=WriteAheadLog(self.path, "never")
+        )
+        processor.recover()
+        for owner in ("alice", "bob", "alice"):
+            processor.process_command(
+                f'ADD SHIFT "hello" {owner} 2024-01-01 3'
+            )
+        processor.process_command("REM owner == alice")
+        assert processor.wal is not None
+        processor.wal.close()
+
+        recovered = CommandProcessor(
+            io.StringIO(), wal=WriteAheadLog(self.path, "never")
+        )
+        self.assertEqual(recovered.recover(), 1)
+        self.assertEqual(
+            [record.get_owner() for record in recovered.texts], ["bob"]
+        )
+        assert recovered.wal is not None
+        recovered.wal.close()
+
+    def test_compaction_keeps_the_checkpoint(self) -> None:
+        directory = os.path.dirname(self.path)
+        processor = CommandProcessor(
+            io.StringIO(), wal=WriteAheadLog(self.path, "never")
+        )
+        processor.recover()
+        for i in range(50):
+            processor.process_command(
+                f'ADD SHIFT "text {i}" owner{i % 5} 2024-01-01 {i}'
+            )
+        snapshot = os.path.join(directory, "store.snap")
+        processor.process_command(f'SAVE "{snapshot}"')
+        processor.process_command(f'LOAD "{snapshot}"')
+        processor.process_command("REM owner == owner1")
+        processor.process_command('ADD SHIFT "late" owner9 2024-01-01 1')
+        processor.process_command("COMPACT")
+        wal = processor.wal
+        assert wal is not None
+        # The store is not expanded into one ADD per record.
+        self.assertEqual((wal.entries, wal.checkpointed), (1, True))
+        expected = [record.render() for record in processor.texts]
+        wal.close()
+        processor.texts.close()
+
+        recovered = CommandProcessor(
+            io.StringIO(), wal=WriteAheadLog(self.path, "never")
+        )
+        self.assertEqual(recovered.recover(), 41)
+        self.assertEqual(
+            [record.render() for record in recovered.texts], expected
+        )
+        assert recovered.wal is not None
+        recovered.wal.close()
+        recovered.texts.close()
+
+    def test_payload_survives_checkpoint_and_compaction(self) -> None:
+        directory = os.path.dirname(self.path)
+        payload = os.path.join(directory, "payload.txt")
+        with open(payload, "w", encoding="utf-8") as file:
+            file.write("hello world")
+        processor = CommandProcessor(
+            io.StringIO(), wal=WriteAheadLog(self.path, "never")
+        )
+        processor.recover()
+        processor.process_command(
+            f'ADD SHIFT @"{payload}" alice 2024-01-01 3'
+        )
+        processor.process_command(
+            f'SAVE "{os.path.join(directory, "store.snap")}"'
+        )
+        processor.process_command("COMPACT")
+        expected = [record.render() for record in processor.texts]
+        assert processor.wal is not None
+        processor.wal.close()
+        processor.texts.close()
+        # Recovery reads the logged copy, not the original file.
+        os.unlink(payload)
+
+        recovered = CommandProcessor(
+            io.StringIO(), wal=WriteAheadLog(self.path, "never")
+        )
+        self.assertEqual(recovered.recover(), 1)
+        self.assertEqual(
+            [record.render() for record in recovered.texts], expected
+        )
+        assert recovered.wal is not None
+        recovered.wal.close()
+        recovered.texts.close()
+
+
+if __name__ == "__main__":
+    unittest.main()